@@ -14,11 +14,17 @@ echo "--- Versión de Java en uso ---"
 java -version
 echo "----------------------------"
 
-# Inicia el servidor Tika en segundo plano
+# Inicia el servidor Tika en segundo plano (una única JVM compartida por todos los hilos)
+TIKA_PORT=9998
 echo "Iniciando Tika Server en segundo plano..."
-java -jar /opt/tika/tika-server.jar --noFork > /tmp/tika.log 2>&1 &
+java -jar /opt/tika/tika-server.jar --noFork -p $TIKA_PORT > /tmp/tika.log 2>&1 &
 TIKA_PID=$!
 
+# tika-python lee estas variables al importarse: usa este servidor en modo
+# solo-cliente, sin descargar su propio jar ni comprobar el servidor en cada llamada.
+export TIKA_SERVER_ENDPOINT="http://127.0.0.1:$TIKA_PORT"
+export TIKA_CLIENT_ONLY=True
+
 # ... (el resto del script de cleanup y ejecución no cambia) ...
 cleanup() {
     echo "--- Mostrando logs de Tika ---"
@@ -29,8 +35,13 @@ cleanup() {
 }
 trap cleanup EXIT
 
-echo "Esperando 10 segundos para que Tika Server se inicie..."
-sleep 10
+echo "Esperando a que Tika Server acepte conexiones en el puerto $TIKA_PORT..."
+for _ in $(seq 1 60); do
+    if (echo > /dev/tcp/127.0.0.1/$TIKA_PORT) 2>/dev/null; then
+        break
+    fi
+    sleep 1
+done
 echo "Tika Server debería estar listo."
 
 echo "Ejecutando el job de Glue: $@"
@@ -0,0 +1,64 @@
+# src/invoice_pipeline/cache.py
+
+import os
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+import orjson
+
+log = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# =========================
+#         Helpers
+# =========================
+def file_sha256(path: str) -> str:
+    """
+    SHA-256 del contenido del archivo, leído por bloques.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# =========================
+#   Caché de filas parseadas
+# =========================
+class ParsedRowsCache:
+    """
+    Caché en disco de las filas parseadas de cada PDF, indexada por la versión del
+    parser y el SHA-256 de su contenido: {base_dir}/v{version}/{sha[:2]}/{sha}.json.
+    No hace falta invalidarla si el archivo cambia de nombre o de ruta, y un cambio
+    de versión del parser deja de leer las filas generadas por la anterior.
+    """
+    def __init__(self, base_dir: str, version: int):
+        self.base_dir = Path(base_dir) / f"v{version}"
+
+    def _path(self, sha256: str) -> Path:
+        return self.base_dir / sha256[:2] / f"{sha256}.json"
+
+    def get(self, sha256: str) -> list[dict] | None:
+        path = self._path(sha256)
+        try:
+            return orjson.loads(path.read_bytes())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("Entrada de caché ilegible en %s: %s", path, e)
+            return None
+
+    def put(self, sha256: str, rows: list[dict]):
+        path = self._path(sha256)
+        # Escritura atómica: otro hilo nunca ve un JSON a medio escribir.
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(orjson.dumps(rows))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # La caché es solo una optimización: un fallo al guardar no invalida el parseo.
+            log.warning("No se pudo guardar la entrada de caché %s: %s", path, e)
@@ -0,0 +1,221 @@
+# src/invoice_pipeline/drive.py
+
+import os
+import json
+import logging
+import random
+import threading
+import time
+
+import backoff
+from google.oauth2 import service_account
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
+
+log = logging.getLogger(__name__)
+
+# =========================
+#   Constantes de Drive
+# =========================
+DRIVE_SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+BATCH_MAX_REQUESTS = 10  # La API admite 100, pero la cuota se cobra por sub-petición
+LIST_PAGE_SIZE = 1000
+LIST_FIELDS = "nextPageToken, files(id, name, mimeType)"
+
+# Límites frente a la cuota de Drive (~10 req/s por usuario)
+DRIVE_MAX_CONCURRENCY = int(os.getenv("DRIVE_MAX_CONCURRENCY", "8"))
+DRIVE_MIN_INTERVAL_S = 0.1
+DOWNLOAD_MAX_TRIES = 5
+BATCH_MAX_TRIES = 5
+BATCH_BACKOFF_BASE_S = 1.0
+BATCH_BACKOFF_MAX_S = 32.0
+RETRYABLE_STATUSES = (403, 429, 500, 503)
+
+# =========================
+#   Control de frecuencia
+# =========================
+class _RateLimiter:
+    """
+    Garantiza un intervalo mínimo entre llamadas, compartido entre hilos.
+    """
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self, calls: int = 1):
+        """
+        Reserva `calls` huecos consecutivos (p. ej. las sub-peticiones de un lote).
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval * calls
+        if slot > now:
+            time.sleep(slot - now)
+
+_drive_semaphore = threading.Semaphore(DRIVE_MAX_CONCURRENCY)
+_drive_rate_limiter = _RateLimiter(DRIVE_MIN_INTERVAL_S)
+
+# =========================
+#         Helpers
+# =========================
+def _load_credentials(credentials_json: str):
+    info = json.loads(credentials_json)
+    if info.get("type") == "service_account":
+        return service_account.Credentials.from_service_account_info(info, scopes=DRIVE_SCOPES)
+    return Credentials.from_authorized_user_info(info, scopes=DRIVE_SCOPES)
+
+class DriveClient:
+    """
+    Cliente de la API de Drive v3 a partir del JSON de credenciales. Las credenciales
+    se comparten, pero cada hilo construye su propio servicio (httplib2.Http no es thread-safe).
+    """
+    def __init__(self, credentials_json: str):
+        self.credentials = _load_credentials(credentials_json)
+        self._local = threading.local()
+
+    @property
+    def service(self):
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = build("drive", "v3", credentials=self.credentials, cache_discovery=False)
+            self._local.service = service
+        return service
+
+def _quote(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+def find_folder_id(service, name: str, parent_folder_id: str) -> str | None:
+    """
+    Busca una subcarpeta por nombre con una sola consulta.
+    """
+    _drive_rate_limiter.wait()
+    response = service.files().list(
+        q=(
+            f"'{parent_folder_id}' in parents and name='{_quote(name)}' "
+            f"and mimeType='{FOLDER_MIME_TYPE}' and trashed=false"
+        ),
+        fields="files(id, name)",
+        pageSize=1,
+        supportsAllDrives=True,
+        includeItemsFromAllDrives=True,
+    ).execute()
+    folders = response.get("files", [])
+    return folders[0]["id"] if folders else None
+
+def _status(e: Exception) -> int | None:
+    return getattr(getattr(e, "resp", None), "status", None)
+
+def batch_list(service, folder_ids: list[str], q_extra: str | None = None) -> dict[str, list[dict]]:
+    """
+    Lista los hijos directos de varias carpetas agrupando las peticiones
+    en lotes HTTP de hasta BATCH_MAX_REQUESTS carpetas, pagando la cuota por sub-petición.
+    Las sub-peticiones que fallan con 403/429/5xx se reencolan con espera exponencial.
+    Si se indica q_extra, solo se devuelven las subcarpetas y los archivos que lo cumplen.
+    """
+    child_filter = f" and (mimeType='{FOLDER_MIME_TYPE}' or ({q_extra}))" if q_extra else ""
+    children: dict[str, list[dict]] = {fid: [] for fid in folder_ids}
+    # (carpeta, token de página, intentos fallidos)
+    pending: list[tuple[str, str | None, int]] = [(fid, None, 0) for fid in folder_ids]
+
+    while pending:
+        chunk, pending = pending[:BATCH_MAX_REQUESTS], pending[BATCH_MAX_REQUESTS:]
+        attempts = {fid: tries for fid, _, tries in chunk}
+        page_tokens = {fid: token for fid, token, _ in chunk}
+        retry: list[tuple[str, str | None, int]] = []
+
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                tries = attempts[request_id] + 1
+                if _status(exception) not in RETRYABLE_STATUSES or tries >= BATCH_MAX_TRIES:
+                    raise exception
+                retry.append((request_id, page_tokens[request_id], tries))
+                return
+            children[request_id].extend(response.get("files", []))
+            if response.get("nextPageToken"):
+                pending.append((request_id, response["nextPageToken"], 0))
+
+        batch = service.new_batch_http_request(callback=on_response)
+        for fid, page_token, _ in chunk:
+            batch.add(
+                service.files().list(
+                    q=f"'{fid}' in parents and trashed=false{child_filter}",
+                    fields=LIST_FIELDS,
+                    pageSize=LIST_PAGE_SIZE,
+                    pageToken=page_token,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                ),
+                request_id=fid,
+            )
+        _drive_rate_limiter.wait(len(chunk))
+        batch.execute()
+
+        if retry:
+            max_tries = max(tries for _, _, tries in retry)
+            delay = min(BATCH_BACKOFF_BASE_S * 2 ** (max_tries - 1), BATCH_BACKOFF_MAX_S)
+            log.warning("Drive rechazó %s sub-peticiones del lote; reintento en %.1f s.", len(retry), delay)
+            time.sleep(delay + random.uniform(0, BATCH_BACKOFF_BASE_S))
+            pending = retry + pending
+
+    return children
+
+def list_all_files_recursively(service, start_folder_id: str, q_extra: str | None = None) -> list[dict]:
+    """
+    Recorre el árbol de carpetas en anchura, con una petición por lotes por nivel.
+    q_extra se aplica en el servidor a los archivos (las carpetas siempre se recorren).
+    """
+    files: list[dict] = []
+    layer = [start_folder_id]
+    depth = 0
+
+    while layer:
+        log.info("Listando nivel %s de Google Drive (%s carpetas).", depth, len(layer))
+        next_layer = []
+        for items in batch_list(service, layer, q_extra).values():
+            for item in items:
+                if item.get("mimeType") == FOLDER_MIME_TYPE:
+                    next_layer.append(item["id"])
+                else:
+                    files.append(item)
+        layer = list(dict.fromkeys(next_layer))  # Una carpeta puede tener varios padres
+        depth += 1
+
+    return files
+
+def list_tree(service, root_folder_id: str, subfolder_name: str, q_extra: str | None = None) -> list[dict]:
+    """
+    Lista recursivamente los archivos de la subcarpeta `subfolder_name` de la raíz:
+    una consulta para localizarla y luego una petición por lotes por nivel.
+    Devuelve [] si la subcarpeta no existe.
+    """
+    folder_id = find_folder_id(service, subfolder_name, root_folder_id)
+    if not folder_id:
+        return []
+    return list_all_files_recursively(service, folder_id, q_extra)
+
+def _is_not_retryable(e: HttpError) -> bool:
+    return _status(e) not in RETRYABLE_STATUSES
+
+@backoff.on_exception(backoff.expo, HttpError, max_tries=DOWNLOAD_MAX_TRIES, giveup=_is_not_retryable)
+def download_file(client: DriveClient, file_id: str, local_path: str) -> str:
+    """
+    Descarga el contenido de un archivo en local_path respetando los límites de Drive,
+    reintentando con espera exponencial ante 403/429/5xx.
+    """
+    with _drive_semaphore:
+        _drive_rate_limiter.wait()
+        request = client.service.files().get_media(fileId=file_id, supportsAllDrives=True)
+        # Se escribe en un .part y se renombra al terminar: un reintento nunca deja un PDF truncado.
+        tmp_path = f"{local_path}.part"
+        with open(tmp_path, "wb") as fh:
+            media = MediaIoBaseDownload(fh, request)
+            done = False
+            while not done:
+                _, done = media.next_chunk()
+        os.replace(tmp_path, local_path)
+    return local_path
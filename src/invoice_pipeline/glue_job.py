@@ -1,8 +1,11 @@
 # /src/invoice_pipeline/glue_job.py
 
+import functools
+import os
 import sys
 import logging
-import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 
 # --- Librerías de AWS Glue (ahora importadas directamente) ---
@@ -12,174 +15,321 @@ from awsglue.context import GlueContext
 from awsglue.job import Job
 
 # --- Librerías de Terceros ---
-import pandas as pd
 import boto3
+import cachetools
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # --- Tus módulos ---
 from py_toolbox.aws.athena_connector import AthenaConnector
-from py_toolbox.google.google_drive_downloader import GoogleDriveDownloader
-from py_toolbox.processing.tika_parser import TikaParser
 from py_toolbox.utils.file_handler import FileHandler
-from invoice_pipeline.parser import ParserService, BusinessException
+from invoice_pipeline.cache import ParsedRowsCache, file_sha256
+from invoice_pipeline.drive import DriveClient, download_file, list_tree
+from invoice_pipeline.parser import PARSER_VERSION, ParserService, BusinessException
+
+# --- Logging: los handlers se configuran en main(), no al importar el módulo ---
+log = logging.getLogger(__name__)
+
+# --- Nombre de los PDF de factura: MCI_Invoice_*.pdf (sin distinguir mayúsculas) ---
+INVOICE_FILENAME_PREFIX = "mci_invoice_"
+INVOICE_FILENAME_SUFFIX = ".pdf"
+# Prefiltro en el servidor de Drive; el filtro local se mantiene como verificación exacta.
+# No se filtra por mimeType: hay PDF subidos como application/octet-stream.
+INVOICE_DRIVE_QUERY = "name contains 'MCI_Invoice_'"
+
+# --- Tamaño objetivo de las particiones al escribir Parquet ---
+ROWS_PER_OUTPUT_PARTITION = 200_000
+MAX_OUTPUT_PARTITIONS = 8
+
+# --- Conexiones persistentes y reintentos adaptativos para los clientes de AWS ---
+BOTO_CONFIG = Config(
+    tcp_keepalive=True,
+    max_pool_connections=32,
+    retries={"mode": "adaptive", "max_attempts": 5},
+)
+
+_SESSION = None
+_session_lock = threading.Lock()  # boto3.Session no es thread-safe al crear clientes
+
+def _session():
+    """
+    Devuelve la única boto3.Session del proceso (el modelo de datos de botocore se carga una vez).
+    """
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = boto3.session.Session()
+    return _SESSION
 
-# --- Configuración del Logging ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+@functools.lru_cache(maxsize=None)
+def _client(service: str, region: str):
+    """
+    Devuelve un cliente de boto3 reutilizable por (servicio, región).
+    """
+    with _session_lock:
+        return _session().client(service_name=service, region_name=region, config=BOTO_CONFIG)
+
+# --- Caché de secretos (1 h) compartida entre hilos ---
+SECRET_CACHE_TTL_S = 3600
+_secret_cache = cachetools.TTLCache(maxsize=8, ttl=SECRET_CACHE_TTL_S)
+
+@cachetools.cached(_secret_cache, lock=threading.Lock())
+def _get_secret_string(secret_name: str, region_name: str) -> str:
+    return _client('secretsmanager', region_name).get_secret_value(SecretId=secret_name)['SecretString']
 
 def get_secret(secret_name: str, region_name: str) -> str | None:
     """
-    Obtiene un secreto de AWS Secrets Manager.
+    Obtiene un secreto de AWS Secrets Manager (cacheado durante la ejecución).
     """
-    session = boto3.session.Session()
-    client = session.client(service_name='secretsmanager', region_name=region_name)
-    logging.info(f"Intentando obtener el secreto: {secret_name}")
+    log.info("Intentando obtener el secreto: %s", secret_name)
     try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
-        secret = get_secret_value_response['SecretString']
-        logging.info("Secreto obtenido exitosamente.")
+        secret = _get_secret_string(secret_name, region_name)
+        log.info("Secreto obtenido exitosamente.")
         return secret
     except ClientError as e:
-        logging.error(f"No se pudo recuperar el secreto '{secret_name}': {e}")
+        log.error("No se pudo recuperar el secreto '%s': %s", secret_name, e)
         return None
 
+@functools.cache
+def _invoice_schema():
+    """
+    Esquema Arrow de las filas parseadas (evita la inferencia de tipos en Arrow/Spark).
+    pyarrow se importa aquí para no cargarlo cuando no hay facturas nuevas.
+    """
+    import pyarrow as pa
+    return pa.schema([
+        ('invoice_number', pa.int64()),
+        ('billing_cycle_date', pa.string()),
+        ('currency', pa.string()),
+        ('event_code', pa.string()),
+        ('description', pa.string()),
+        ('service_code', pa.string()),
+        ('uom', pa.string()),
+        ('quantity_amount', pa.float64()),
+        ('rate', pa.float64()),
+        ('charge', pa.float64()),
+        ('tax_amount', pa.float64()),
+        ('total_charge', pa.float64()),
+        ('file_id', pa.string()),
+        ('file_name', pa.string()),
+        ('processing_timestamp', pa.string()),
+    ])
+
+def _is_invoice_filename(name: str) -> bool:
+    """
+    Equivale a ^MCI_Invoice_.*\\.pdf$ (sin distinguir mayúsculas) sin usar regex.
+    """
+    lower = name.lower()
+    return lower.startswith(INVOICE_FILENAME_PREFIX) and lower.endswith(INVOICE_FILENAME_SUFFIX)
+
+def _claim_invoice(ctx: dict, inv_no: int) -> bool:
+    """
+    Reserva un N° de factura para este hilo. Devuelve False si ya fue procesado
+    en una ejecución anterior o si otro archivo de este lote ya lo reservó.
+    """
+    with ctx['invoice_lock']:
+        if inv_no in ctx['processed_invoice_numbers'] or inv_no in ctx['claimed_invoices']:
+            return False
+        ctx['claimed_invoices'].add(inv_no)
+        return True
+
+def _release_invoice(ctx: dict, inv_no: int):
+    with ctx['invoice_lock']:
+        ctx['claimed_invoices'].discard(inv_no)
+
+def _process_one(file_info: dict, ctx: dict) -> dict:
+    """
+    Procesa una factura (descarga, conversión y parseo) y devuelve su estado y filas.
+    `ctx` contiene los conectores y el estado compartido del lote (ver run_pipeline).
+    """
+    file_id, file_name = file_info['id'], file_info['name']
+    log.info("--> Procesando: %s (ID: %s)", file_name, file_id)
+    claimed_inv_no = None
+
+    try:
+        # El file_id en el nombre local evita que dos PDF homónimos de distintas
+        # subcarpetas se pisen (también el .html de depuración, que toma su nombre).
+        local_name = f"{file_id}_{file_name}".replace(os.sep, "_")
+        local_pdf_path = download_file(ctx['drive'], file_id, os.path.join(ctx['downloads_dir'], local_name))
+
+        # Si este mismo PDF ya se parseó antes, se reutilizan sus filas sin pasar por Tika.
+        digest = file_sha256(local_pdf_path)
+        parsed_rows = ctx['rows_cache'].get(digest)
+        if parsed_rows is not None:
+            log.info("Filas de %s recuperadas de la caché (sha256: %s).", file_name, digest)
+            inv_no = parsed_rows[0]['invoice_number']
+        else:
+            # El HTML se guarda en disco para depuración, pero se parsea desde memoria.
+            html_text, _ = ctx['parser'].pdf_to_html(local_pdf_path, ctx['html_output_dir'])
+            # Un único parseo por archivo: los mismos párrafos sirven para metadatos y filas.
+            paragraphs = ctx['parser'].parse_html_text(html_text)
+
+            meta = ctx['parser'].extract_invoice_meta_from_paragraphs(paragraphs)
+            inv_no = meta[0]
+            if not inv_no:
+                log.error("FALLO METADATOS: No se pudo extraer N° de factura de %s.", file_name)
+                return {"status": "metadata_extraction_failed", "rows": []}
+
+        if not _claim_invoice(ctx, inv_no):
+            log.warning("SALTANDO DUPLICADO: La factura N° %s del archivo %s ya fue procesada.", inv_no, file_name)
+            return {"status": "skipped_duplicates", "rows": []}
+        claimed_inv_no = inv_no
+
+        if parsed_rows is None:
+            log.info("Parseando: %s (Factura N° %s).", file_name, inv_no)
+            parsed_rows = ctx['parser'].run_from_paragraphs(paragraphs, meta=meta)
+            if not parsed_rows:
+                raise BusinessException("PARSER_EMPTY_RESULT", "El parser no devolvió ninguna fila de detalle.")
+            ctx['rows_cache'].put(digest, parsed_rows)
+
+        file_columns = {
+            'file_id': file_id,
+            'file_name': file_name,
+            'processing_timestamp': ctx['processing_timestamp'],
+        }
+
+        log.info("<-- ÉXITO: %s parseado correctamente.", file_name)
+        return {"status": "processed_successfully", "rows": [row | file_columns for row in parsed_rows]}
+
+    except Exception as e:
+        # Si falla, otro archivo con el mismo N° de factura puede volver a intentarlo.
+        if claimed_inv_no is not None:
+            _release_invoice(ctx, claimed_inv_no)
+        log.error("<-- ERROR al procesar %s: %s", file_name, e)
+        log.debug("Traza del error al procesar %s", file_name, exc_info=True)
+        return {"status": "failed_to_process", "rows": []}
+
 def run_pipeline(spark, args):
     """
     Esta función contiene la lógica de negocio principal.
     """
-    logging.info(f"Argumentos recibidos: {args}")
+    log.info("Argumentos recibidos: %s", args)
 
     # --- 1. Definición de directorios de trabajo ---
     # Se asume siempre un entorno tipo Glue, por lo que usamos /tmp
     base_dir = "/tmp"
     downloads_dir = f"{base_dir}/downloads"
     html_output_dir = f"{base_dir}/html_output"
-    FileHandler.ensure_dirs(downloads_dir, html_output_dir)
+    cache_dir = os.getenv("PARSE_CACHE_DIR", f"{base_dir}/cache")
+    FileHandler.ensure_dirs(downloads_dir, html_output_dir, cache_dir)
 
     # --- 2. Inicialización de Conectores ---
     gdrive_credentials_json = get_secret(args['GDRIVE_SECRET_NAME'], args['AWS_REGION'])
     if not gdrive_credentials_json:
         raise RuntimeError("FINALIZANDO: No se pudieron obtener las credenciales de Google Drive.")
 
-    downloader = GoogleDriveDownloader(gdrive_credentials_json, downloads_dir)
+    drive = DriveClient(gdrive_credentials_json)
     parser = ParserService()
     athena = AthenaConnector(args['ATHENA_DATABASE'], args['S3_OUTPUT_BUCKET'], args['AWS_REGION'])
 
     # --- 3. Descubrimiento de Archivos y Duplicados (Lógica sin cambios) ---
     try:
-        logging.info("--- Fase 1: Descubrimiento de Archivos y Duplicados ---")
-        processed_file_ids = athena.get_processed_file_ids(args['ATHENA_TABLE'])
-        processed_invoice_numbers = athena.get_processed_invoice_numbers(args['ATHENA_TABLE'])
+        log.info("--- Fase 1: Descubrimiento de Archivos y Duplicados ---")
+        # Las dos consultas son independientes: se lanzan a la vez para pagar una sola latencia de Athena.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            file_ids_future = executor.submit(athena.get_processed_file_ids, args['ATHENA_TABLE'])
+            invoice_numbers_future = executor.submit(athena.get_processed_invoice_numbers, args['ATHENA_TABLE'])
+            processed_file_ids = frozenset(file_ids_future.result())
+            processed_invoice_numbers = frozenset(invoice_numbers_future.result())
+        log.info(
+            "Histórico en Athena: %s archivos y %s facturas ya procesadas.",
+            len(processed_file_ids), len(processed_invoice_numbers),
+        )
 
         main_folder_id = args['GDRIVE_ROOT_FOLDER_ID']
-        logging.info(f"ID de la carpeta raíz de Google Drive: {main_folder_id}")
+        log.info("ID de la carpeta raíz de Google Drive: %s", main_folder_id)
 
         current_year = str(datetime.now().year)
-        year_folder_id = downloader.get_folder_id(current_year, parent_folder_id=main_folder_id)
-
-        all_files = downloader.list_all_files_recursively(start_folder_id=year_folder_id) if year_folder_id else []
+        all_files = list_tree(drive.service, main_folder_id, current_year, INVOICE_DRIVE_QUERY)
         if not all_files:
-            logging.warning(f"No se encontró la subcarpeta para el año {current_year} o no contiene archivos.")
+            log.warning("No se encontró la subcarpeta para el año %s o no contiene archivos.", current_year)
 
-        invoice_filename_pattern = re.compile(r"^MCI_Invoice_.*\.pdf$", re.IGNORECASE)
         files_to_process = [
             f for f in all_files
-            if invoice_filename_pattern.match(f['name']) and f['id'] not in processed_file_ids
+            if _is_invoice_filename(f['name']) and f['id'] not in processed_file_ids
         ]
 
         if not files_to_process:
-            logging.info("No se encontraron facturas nuevas para procesar. Proceso finalizado.")
+            log.info("No se encontraron facturas nuevas para procesar. Proceso finalizado.")
             return
 
-        logging.info(f"Se encontraron {len(files_to_process)} facturas candidatas para procesar.")
+        log.info("Se encontraron %s facturas candidatas para procesar.", len(files_to_process))
 
     except Exception as e:
         raise RuntimeError(f"FINALIZANDO: Falló la fase de descubrimiento. Error: {e}")
 
     # --- 4. Procesamiento de Cada Archivo (Lógica sin cambios) ---
-    logging.info("--- Fase 2: Procesamiento de Archivos ---")
+    log.info("--- Fase 2: Procesamiento de Archivos ---")
     all_processed_rows = []
     summary = {"processed_successfully": 0, "failed_to_process": 0, "skipped_duplicates": 0, "metadata_extraction_failed": 0}
 
-    for file_info in files_to_process:
-        file_id, file_name = file_info['id'], file_info['name']
-        logging.info(f"--> Procesando: {file_name} (ID: {file_id})")
-
-        try:
-            local_pdf_path = downloader.download_file(file_id, file_name)
-            if not local_pdf_path:
-                raise Exception("La descarga desde Google Drive falló.")
-
-            html_path = TikaParser.pdf_to_html(local_pdf_path, html_output_dir)
-            if not html_path:
-                raise Exception("La conversión de PDF a HTML con Tika falló.")
-
-            inv_no, _, _ = parser.extract_invoice_meta(html_path)
-            if not inv_no:
-                logging.error(f"FALLO METADATOS: No se pudo extraer N° de factura de {file_name}.")
-                summary["metadata_extraction_failed"] += 1
-                continue
-
-            if inv_no in processed_invoice_numbers:
-                logging.warning(f"SALTANDO DUPLICADO: La factura N° {inv_no} del archivo {file_name} ya fue procesada.")
-                summary["skipped_duplicates"] += 1
-                continue
-
-            logging.info(f"Parseando: {file_name} (Factura N° {inv_no}).")
-            parsed_rows = parser.run(html_path)
-            if not parsed_rows:
-                raise BusinessException("PARSER_EMPTY_RESULT", "El parser no devolvió ninguna fila de detalle.")
-
-            timestamp = datetime.now(timezone.utc).isoformat()
-            for row in parsed_rows:
-                row.update({'file_id': file_id, 'file_name': file_name, 'processing_timestamp': timestamp})
-            
-            all_processed_rows.extend(parsed_rows)
-            summary["processed_successfully"] += 1
-            logging.info(f"<-- ÉXITO: {file_name} parseado correctamente.")
-
-        except Exception as e:
-            logging.error(f"<-- ERROR al procesar {file_name}: {e}", exc_info=True)
-            summary["failed_to_process"] += 1
+    max_workers = int(os.getenv("PIPELINE_WORKERS", "8"))
+    log.info("Procesando archivos con %s hilos en paralelo.", max_workers)
+
+    ctx = {
+        'drive': drive,
+        'downloads_dir': downloads_dir,
+        'parser': parser,
+        'html_output_dir': html_output_dir,
+        'rows_cache': ParsedRowsCache(cache_dir, PARSER_VERSION),
+        'processing_timestamp': datetime.now(timezone.utc).isoformat(),  # Una única marca para todo el lote
+        'processed_invoice_numbers': processed_invoice_numbers,
+        'claimed_invoices': set(),  # Facturas reservadas por algún hilo en este lote (protegido por invoice_lock)
+        'invoice_lock': threading.Lock(),
+    }
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_process_one, f, ctx) for f in files_to_process]
+        # Los resultados se agregan solo en este hilo, por lo que summary no necesita lock.
+        for future in as_completed(futures):
+            result = future.result()
+            summary[result["status"]] += 1
+            all_processed_rows.extend(result["rows"])
 
     # --- 5. Guardado de Datos en Formato Parquet (Lógica sin cambios) ---
     if not all_processed_rows:
-        logging.warning("No se procesaron filas nuevas. No hay datos para guardar en S3.")
+        log.warning("No se procesaron filas nuevas. No hay datos para guardar en S3.")
     else:
         try:
-            logging.info(f"--- Fase 3: Guardando {len(all_processed_rows)} filas ---")
-            
-            pd_df = pd.DataFrame(all_processed_rows)
-            
-            pd_df['billing_cycle_date'] = pd.to_datetime(pd_df['billing_cycle_date'])
-            pd_df['year'] = pd_df['billing_cycle_date'].dt.year
-            pd_df['month'] = pd_df['billing_cycle_date'].dt.month
-            pd_df['billing_cycle_date'] = pd_df['billing_cycle_date'].dt.date
-            
-            numeric_cols = ['quantity_amount', 'rate', 'charge', 'tax_amount', 'total_charge']
-            for col in numeric_cols:
-                pd_df[col] = pd.to_numeric(pd_df[col], errors='coerce')
-            
-            spark_df = spark.createDataFrame(pd_df)
+            log.info("--- Fase 3: Guardando %s filas ---", len(all_processed_rows))
+            import pyarrow as pa
+            import pyarrow.compute as pc
+            from pyspark.sql.pandas.types import from_arrow_schema
             
+            # Construcción columnar directa en Arrow con esquema fijo (sin inferencia de tipos).
+            tbl = pa.Table.from_pylist(all_processed_rows, schema=_invoice_schema())
+            # El parser emite date.isoformat(): el cast directo a date32 es exacto y falla
+            # (en lugar de dejar nulos silenciosos) si alguna vez llega otro formato.
+            billing_dates = tbl['billing_cycle_date'].cast(pa.date32())
+            tbl = tbl.set_column(tbl.schema.get_field_index('billing_cycle_date'), 'billing_cycle_date', billing_dates)
+            tbl = tbl.append_column('year', pc.year(billing_dates))
+            tbl = tbl.append_column('month', pc.month(billing_dates))
+
+            # Con Arrow habilitado en la sesión, la transferencia a la JVM es columnar.
+            spark_df = spark.createDataFrame(tbl.to_pandas(), schema=from_arrow_schema(tbl.schema))
+
             s3_output_path = f"s3://{args['S3_OUTPUT_BUCKET']}/invoices/mastercard/"
-            logging.info(f"Escribiendo DataFrame en formato Parquet en: {s3_output_path}")
-            spark_df.write.partitionBy("year", "month").mode("append").parquet(s3_output_path)
+            log.info("Escribiendo DataFrame en formato Parquet en: %s", s3_output_path)
+            # Pocas particiones para evitar ficheros pequeños por year/month (ya conocemos el nº de filas).
+            target_partitions = max(1, min(len(all_processed_rows) // ROWS_PER_OUTPUT_PARTITION + 1, MAX_OUTPUT_PARTITIONS))
+            spark_df.coalesce(target_partitions).write.partitionBy("year", "month").mode("append").parquet(s3_output_path)
 
-            logging.info("Escritura de datos completada exitosamente.")
+            log.info("Escritura de datos completada exitosamente.")
 
         except Exception as e:
             raise RuntimeError(f"FINALIZANDO: Falló la escritura de datos. Error: {e}")
 
     # --- 6. Resumen Final (Lógica sin cambios) ---
-    logging.info("=======================================")
-    logging.info("======= PROCESO FINALIZADO =======")
-    logging.info(f"Archivos procesados con éxito: {summary['processed_successfully']}")
-    logging.info(f"Archivos que fallaron durante el proceso: {summary['failed_to_process']}")
-    logging.info(f"Archivos que fallaron por extracción de metadatos: {summary['metadata_extraction_failed']}")
-    logging.info(f"Archivos saltados por duplicado: {summary['skipped_duplicates']}")
-    logging.info("=======================================")
+    log.info("=======================================")
+    log.info("======= PROCESO FINALIZADO =======")
+    log.info("Archivos procesados con éxito: %s", summary['processed_successfully'])
+    log.info("Archivos que fallaron durante el proceso: %s", summary['failed_to_process'])
+    log.info("Archivos que fallaron por extracción de metadatos: %s", summary['metadata_extraction_failed'])
+    log.info("Archivos saltados por duplicado: %s", summary['skipped_duplicates'])
+    log.info("=======================================")
 
 def main():
+    # force=True reemplaza los handlers que el runtime de Glue deja en el logger raíz.
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', force=True)
 
     args = getResolvedOptions(sys.argv, [
         'JOB_NAME', 'GDRIVE_ROOT_FOLDER_ID', 'GDRIVE_SECRET_NAME',
@@ -188,6 +338,7 @@ def main():
     sc = SparkContext()
     glueContext = GlueContext(sc)
     spark = glueContext.spark_session
+    spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
     job = Job(glueContext)
     job.init(args['JOB_NAME'], args)
 
@@ -195,7 +346,7 @@ def main():
         run_pipeline(spark, args)
         job.commit()
     except Exception as e:
-        logging.critical(f"El job ha fallado con una excepción no controlada: {e}", exc_info=True)
+        log.critical("El job ha fallado con una excepción no controlada: %s", e, exc_info=True)
         raise e
 
 if __name__ == "__main__":
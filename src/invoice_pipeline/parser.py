@@ -1,10 +1,15 @@
 # src/invoice_pipeline/parser.py
 
+import os
 import re
 import logging
+import functools
 from datetime import date
 from pathlib import Path
 from bs4 import BeautifulSoup
+from tika import parser as tika_parser
+
+log = logging.getLogger(__name__)
 
 # =========================
 #   Excepción de negocio
@@ -20,19 +25,21 @@ class BusinessException(Exception):
 NUM_RX = r"-?[\d,]+(?:\.\d+)?"
 ONLY_NUM_RX = re.compile(rf"^{NUM_RX}$")
 
+# Se aplica con finditer sobre todo el texto ya normalizado (un espacio entre
+# palabras, sin espacios en los bordes de línea): cada match es una línea completa.
 ROW_RX = re.compile(
     rf"""^
-    (?P<event_code>[A-Z0-9]+)\s+
-    (?P<description>.*?)\s+
-    (?P<service_code>[A-Z0-9]{{1,4}})\s+
-    (?P<uom>[A-Z])\s+
-    (?P<qty>{NUM_RX})\s+
-    (?P<rate>{NUM_RX})\s+
-    (?P<charge>{NUM_RX})\s+
-    (?P<tax>{NUM_RX})\s+
+    (?P<event_code>[A-Z0-9]+)[ ]
+    (?P<description>.*?)[ ]
+    (?P<service_code>[A-Z0-9]{{1,4}})[ ]
+    (?P<uom>[A-Z])[ ]
+    (?P<qty>{NUM_RX})[ ]
+    (?P<rate>{NUM_RX})[ ]
+    (?P<charge>{NUM_RX})[ ]
+    (?P<tax>{NUM_RX})[ ]
     (?P<total>{NUM_RX})
     $""",
-    re.VERBOSE,
+    re.MULTILINE | re.VERBOSE,
 )
 INVOICE_FIELD_RX = re.compile(
     r"(?:Invoice\s*(?:#|No\.?|Number)?\s*:?\s*)(\d[\d\-]{9,})",
@@ -44,6 +51,10 @@ BILLING_DATE_RX = re.compile(
     re.IGNORECASE,
 )
 CURRENCY_RX = re.compile(r"Currency\s*:\s*([A-Z]{3})", re.IGNORECASE)
+DIGITS_ONLY_RX = re.compile(r"\D")
+INLINE_SPACE_RX = re.compile(r"[^\S\n]+")
+LINE_EDGE_SPACE_RX = re.compile(r" ?\n ?")
+LOOSE_NUM_RX = re.compile(r"(\d[\d\s\-]{8,})")
 MONTHS = {
     "JAN": 1, "FEB": 2, "MAR": 3, "APR": 4, "MAY": 5, "JUN": 6,
     "JUL": 7, "AUG": 8, "SEP": 9, "OCT": 10, "NOV": 11, "DEC": 12
@@ -53,12 +64,41 @@ HEADER_SIGNATURE_PARTS = [
     "Code Description Code UOM Amount Rate Charge Amount Charge",
 ]
 
+# Versión del formato de las filas emitidas: subirla con cualquier cambio del parser
+# que altere su salida invalida las entradas de ParsedRowsCache de versiones anteriores.
+PARSER_VERSION = 1
+
+HTML_PARSER = "lxml"  # libxml2 (C); mucho más rápido que "html.parser"
+HTML_CACHE_SIZE = 16  # Suficiente para los hilos que procesan facturas a la vez
+
 # =========================
 #         Helpers
 # =========================
+def _build_tree(html_text: str) -> tuple[BeautifulSoup, tuple]:
+    soup = BeautifulSoup(html_text, HTML_PARSER)
+    return soup, tuple(soup.find_all("p"))
+
+@functools.lru_cache(maxsize=HTML_CACHE_SIZE)
+def _load_html(real_path: str, mtime_ns: int) -> tuple[BeautifulSoup, tuple]:
+    return _build_tree(Path(real_path).read_text(encoding="utf-8"))
+
+def _parse_html(html_path: str) -> tuple[BeautifulSoup, tuple]:
+    """
+    Devuelve (soup, párrafos <p>) del HTML, parseándolo una sola vez por archivo
+    (memoizado por ruta real y mtime).
+    """
+    real_path = os.path.realpath(html_path)
+    return _load_html(real_path, os.stat(real_path).st_mtime_ns)
+
 def norm(s: str | None) -> str:
     return " ".join((s or "").replace("\xa0", " ").strip().split())
 
+def norm_lines(text: str) -> str:
+    """
+    Equivale a aplicar norm() a cada línea, pero en dos pasadas de regex sobre todo el texto.
+    """
+    return LINE_EDGE_SPACE_RX.sub("\n", INLINE_SPACE_RX.sub(" ", text)).strip(" ")
+
 def is_subtotal_line(line: str) -> bool:
     return bool(ONLY_NUM_RX.fullmatch(line.strip()))
 
@@ -72,28 +112,59 @@ def to_float(s: str) -> float:
     except (ValueError, TypeError):
         return 0.0
 
+def digits_only(s: str) -> str:
+    return DIGITS_ONLY_RX.sub("", s)
+
+def grab_number(text: str) -> int | None:
+    m = INVOICE_FIELD_RX.search(text)
+    if m: return int(digits_only(m.group(1)))
+    m2 = LOOSE_NUM_RX.search(text)
+    if m2: return int(digits_only(m2.group(1)))
+    return None
+
+def grab_billing_date(text: str) -> date | None:
+    m = BILLING_DATE_RX.search(text)
+    if not m: return None
+    mon, day, year = m.groups()
+    mon = mon.upper()
+    if mon not in MONTHS: return None
+    try:
+        return date(int(year), MONTHS[mon], int(day))
+    except ValueError:
+        return None
+
+def grab_currency(text: str) -> str | None:
+    m = CURRENCY_RX.search(text)
+    return m.group(1).upper() if m else None
+
 def fuzzy_best(s: str, candidates: list[str]) -> tuple[str | None, float]:
-    s_n = norm(s).lower()
-    best, score = None, 0.0
-    for c in candidates:
-        r = SequenceMatcher(None, s_n, norm(c).lower()).ratio()
-        if r > score:
-            best, score = c, r
-    return best, score
+    """
+    Candidato más parecido a `s` y su similitud en [0, 1] (rapidfuzz, similitud Indel).
+    Ojo: no coincide con difflib.SequenceMatcher.ratio() en todos los casos.
+    """
+    from rapidfuzz import fuzz, process  # Solo se carga si alguien usa este helper
+    match = process.extractOne(norm(s).lower(), [norm(c).lower() for c in candidates], scorer=fuzz.ratio)
+    if not match or match[1] <= 0:
+        return None, 0.0
+    return candidates[match[2]], match[1] / 100.0
 
 # =========================
 #     Servicio principal
 # =========================
 class ParserService:
     def __init__(self):
-        logging.info("ParserService inicializado.")
-    def pdf_to_html(self, pdf_path: str) -> str:
+        log.info("ParserService inicializado.")
+    def pdf_to_html(self, pdf_path: str, html_output_dir: str) -> tuple[str, str]:
+        """
+        Convierte el PDF a HTML con Tika. Devuelve (html, ruta del .html): el archivo
+        se guarda para depuración, pero el parseo puede hacerse desde el texto en memoria.
+        """
         pdf_path_obj = Path(pdf_path)
         # Creamos un nombre de archivo HTML basado en el nombre del PDF
         html_file_name = pdf_path_obj.stem + ".html"
-        html_out_path = self.dirs["html_output"] / html_file_name
+        html_out_path = Path(html_output_dir) / html_file_name
 
-        logging.info(f"Iniciando conversión de PDF a HTML para: {pdf_path}")
+        log.info("Iniciando conversión de PDF a HTML para: %s", pdf_path)
         try:
             parsed = tika_parser.from_file(str(pdf_path), xmlContent=True)
             html = parsed.get("content")
@@ -102,39 +173,25 @@ class ParserService:
                 raise BusinessException("TIKA_EMPTY_CONTENT", "Tika no pudo extraer contenido.")
 
             html_out_path.write_text(html, encoding="utf-8")
-            logging.info(f"HTML generado en: {html_out_path}")
-            return str(html_out_path)
+            log.info("HTML generado en: %s", html_out_path)
+            return html, str(html_out_path)
+        except BusinessException:
+            raise
         except Exception as e:
             raise BusinessException("TIKA_FAILURE", f"Error procesando PDF con Tika: {e}")
     def extract_invoice_meta(self, html_path: str) -> tuple[int | None, date | None, str | None]:
-        soup = BeautifulSoup(Path(html_path).read_text(encoding="utf-8"), "html.parser")
-        ps = soup.find_all("p")
-
-        def digits_only(s: str) -> str:
-            return re.sub(r"\D", "", s)
-
-        def grab_number(text: str) -> int | None:
-            m = INVOICE_FIELD_RX.search(text)
-            if m: return int(digits_only(m.group(1)))
-            m2 = re.search(r"(\d[\d\s\-]{8,})", text)
-            if m2: return int(digits_only(m2.group(1)))
-            return None
-
-        def grab_billing_date(text: str) -> date | None:
-            m = BILLING_DATE_RX.search(text)
-            if not m: return None
-            mon, day, year = m.groups()
-            mon = mon.upper()
-            if mon not in MONTHS: return None
-            try:
-                return date(int(year), MONTHS[mon], int(day))
-            except ValueError:
-                return None
-
-        def grab_currency(text: str) -> str | None:
-            m = CURRENCY_RX.search(text)
-            return m.group(1).upper() if m else None
-
+        _, ps = _parse_html(html_path)
+        return self._extract_meta(ps)
+    def parse_html_text(self, html_text: str) -> tuple:
+        """
+        Parsea el HTML en memoria y devuelve sus párrafos <p>. No se cachea: quien
+        llama parsea una vez y pasa los párrafos a los métodos *_from_paragraphs.
+        """
+        _, ps = _build_tree(html_text)
+        return ps
+    def extract_invoice_meta_from_paragraphs(self, ps: tuple) -> tuple[int | None, date | None, str | None]:
+        return self._extract_meta(ps)
+    def _extract_meta(self, ps: tuple) -> tuple[int | None, date | None, str | None]:
         inv_no = inv_dt = curr = None
         for i, p in enumerate(ps):
             if norm(p.get_text()).lower() == "invoice":
@@ -151,45 +208,58 @@ class ParserService:
             inv_dt = inv_dt or grab_billing_date(full_text)
             curr = curr or grab_currency(full_text)
 
-        if inv_no is None: logging.warning("No se encontró 'Invoice # <nro>'.")
-        if inv_dt is None: logging.warning("No se encontró 'Billing Cycle Date: <MON DD YYYY>'.")
-        if curr is None: logging.warning("No se encontró 'Currency: <CCC>'.")
+        if inv_no is None: log.warning("No se encontró 'Invoice # <nro>'.")
+        if inv_dt is None: log.warning("No se encontró 'Billing Cycle Date: <MON DD YYYY>'.")
+        if curr is None: log.warning("No se encontró 'Currency: <CCC>'.")
 
         return inv_no, inv_dt, curr
-    def parse_detail_table(self, html_path: str) -> list[dict]:
-            soup = BeautifulSoup(Path(html_path).read_text(encoding="utf-8"), "html.parser")
-            invoice_number, billing_date, currency = self.extract_invoice_meta(html_path)
-            paras = [p.get_text("\n") for p in soup.find_all("p")]
+    def parse_detail_table(self, html_path: str, meta: tuple | None = None) -> list[dict]:
+            _, ps = _parse_html(html_path)
+            return self._parse_rows(ps, meta or self._extract_meta(ps))
+    def _parse_rows(self, ps: tuple, meta: tuple) -> list[dict]:
+            invoice_number, billing_date, currency = meta
+            full_text = norm_lines("\n".join(p.get_text("\n") for p in ps))
+            billing_date_iso = billing_date.isoformat() if billing_date else None
             rows_out: list[dict] = []
 
-
-            for idx, ptxt in enumerate(paras):
-                for line in ptxt.split("\n"):
-                    m = ROW_RX.match(norm(line))
-                    if not m: 
-                        continue
-                    gd = m.groupdict()
-                    rows_out.append({
-                        "invoice_number": invoice_number,
-                        "billing_cycle_date": billing_date.isoformat() if billing_date else None,
-                        "currency": currency,
-                        "event_code": gd["event_code"], "description": gd["description"],
-                        "service_code": gd["service_code"], "uom": gd["uom"],
-                        "quantity_amount": to_float(gd["qty"]), "rate": to_float(gd["rate"]),
-                        "charge": to_float(gd["charge"]), "tax_amount": to_float(gd["tax"]),
-                        "total_charge": to_float(gd["total"]),
-                    })
+            for m in ROW_RX.finditer(full_text):
+                gd = m.groupdict()
+                rows_out.append({
+                    "invoice_number": invoice_number,
+                    "billing_cycle_date": billing_date_iso,
+                    "currency": currency,
+                    "event_code": gd["event_code"], "description": gd["description"],
+                    "service_code": gd["service_code"], "uom": gd["uom"],
+                    "quantity_amount": to_float(gd["qty"]), "rate": to_float(gd["rate"]),
+                    "charge": to_float(gd["charge"]), "tax_amount": to_float(gd["tax"]),
+                    "total_charge": to_float(gd["total"]),
+                })
             return rows_out
 
-    def run(self, html_path: str) -> list[dict]:
+    def run(self, html_path: str, meta: tuple | None = None) -> list[dict]:
         """
         Ejecuta el pipeline de parseo desde un archivo HTML.
+        Si se pasa `meta` (resultado de extract_invoice_meta), no se vuelve a extraer.
         """
         if not html_path or not Path(html_path).exists():
             raise BusinessException("INPUT_MISSING", f"El archivo HTML no se encuentra en: {html_path}")
 
-        logging.info(f"Iniciando parseo del archivo HTML: {html_path}")
-        rows = self.parse_detail_table(html_path)
+        log.info("Iniciando parseo del archivo HTML: %s", html_path)
+        meta = meta or self.extract_invoice_meta(html_path)
+        rows = self.parse_detail_table(html_path, meta)
+
+        log.info("Parseo completado. Se extrajeron %s filas.", len(rows))
+        return rows
+
+    def run_from_paragraphs(self, ps: tuple, meta: tuple | None = None) -> list[dict]:
+        """
+        Igual que run(), pero desde los párrafos de parse_html_text (sin volver a parsear el HTML).
+        """
+        if not ps:
+            raise BusinessException("INPUT_MISSING", "No se recibió contenido HTML para parsear.")
+
+        log.info("Iniciando parseo del HTML en memoria.")
+        rows = self._parse_rows(ps, meta or self._extract_meta(ps))
 
-        logging.info(f"Parseo completado. Se extrajeron {len(rows)} filas.")
+        log.info("Parseo completado. Se extrajeron %s filas.", len(rows))
         return rows